@@ -1,23 +1,23 @@
 """
 main.py ──────────────────────────────────────────────────────
-Dependencies:  pip install fastapi[all] httpx spotipy python-dotenv
+Dependencies:  pip install fastapi[all] httpx[http2] cachetools orjson python-dotenv
 Environment:   CLIENT_ID  CLIENT_SECRET  (generated from Spotify Developer Console)
               PORT=8000 (optional)
 Start:         uvicorn main:app --host 0.0.0.0 --port ${PORT:-8000}
 """
 from pprint import pprint
-import os, asyncio, time
+import os, asyncio, time, threading
 from itertools import islice
-from typing import List
+from typing import Iterable, Iterator, List
 
 import httpx
-import spotipy
-from spotipy.oauth2 import SpotifyClientCredentials
+from cachetools import LRUCache, TTLCache, cached
 from fastapi import FastAPI, APIRouter, Request, HTTPException, Response, Query
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse
 
 from merge_dict import merge_missing_props_by_id
 from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 import csv
 from io import StringIO
 
@@ -29,109 +29,193 @@ if not CID or not CSC:
     raise RuntimeError("CLIENT_ID and CLIENT_SECRET environment variables must be set")
 
 SPOTIFY_API_ROOT = "https://api.spotify.com"
+SPOTIFY_TOKEN_URL = "https://accounts.spotify.com/api/token"
 MAX_PAR = 15                     # Concurrency threshold for track requests
+MAX_RETRY = 3                    # Retries on Spotify 429 (rate limited)
+
+# C-implemented itertools.batched on 3.12+; tuple-yielding fallback for 3.11
+try:
+    from itertools import batched
+except ImportError:
+    def batched(it, n):
+        it = iter(it)
+        while batch := tuple(islice(it, n)):
+            yield batch
 
-# For Python 3.11 compatibility for batched
-# try:
-#     from itertools import batched
-# except ImportError:
-def batched(it, n):
-    it = iter(it)
-    while batch := list(islice(it, n)):
-        yield batch
-
-# Add this helper function after the existing imports
-def inferred_artist_genres(artist_id: str, sp) -> list[str]:
-    """
-    Fetch genres for a given artist and return a sorted list.
-    """
-    artist = sp.artist(artist_id)   # full Artist object
-    genres = artist.get("genres", [])
-    return [genre.capitalize() for genre in genres]
 
 # ─── FastAPI init ───────────────────────────────────────────
-app = FastAPI(title="Spotify Proxy + Album Expander")
+app = FastAPI(title="Spotify Proxy + Album Expander",
+              default_response_class=ORJSONResponse)   # orjson: C-native encoding
 
 # Global httpx connection pool
 _client: httpx.AsyncClient | None = None
 
-# Wrapper for Spotipy (synchronous API)
-sp: spotipy.Spotify | None = None
-
 @app.on_event("startup")
 async def startup() -> None:
-    global _client, sp
-    _client = httpx.AsyncClient(base_url=SPOTIFY_API_ROOT, timeout=30)
-
-    auth = SpotifyClientCredentials(client_id=CID, client_secret=CSC)
-    sp = spotipy.Spotify(auth_manager=auth, requests_timeout=15, retries=3)
+    global _client
+    # Single upstream host: HTTP/2 multiplexes the concurrent fan-out over one connection
+    _client = httpx.AsyncClient(
+        base_url=SPOTIFY_API_ROOT,
+        http2=True,
+        timeout=30,
+        limits=httpx.Limits(max_connections=MAX_PAR * 4,
+                            max_keepalive_connections=MAX_PAR * 4,
+                            keepalive_expiry=60),
+    )
 
 @app.on_event("shutdown")
 async def shutdown() -> None:
     await _client.aclose()        # type: ignore[arg-type]
 
-# ─── Tool: Get / Refresh token (for httpx transparent proxy) ───────
-_token = ""; _exp = 0
+# ─── Tool: Get / Refresh token (client credentials, cached until expiry) ───
+_token = ""; _exp = 0.0
+_token_lock = asyncio.Lock()
 async def bearer() -> str:
-    return sp.auth_manager.get_access_token(as_dict=False)   # Spotipy ≥2.23
-
-    # global _token, _exp
-    # if _token and _exp - 60 > time.time():     # Refresh one minute ahead
-    #     return _token
-    #
-    # basic = httpx.BasicAuth(CID, CSC)
-    # data  = {"grant_type":"client_credentials"}
-    # r = await _client.post("/api/token", auth=basic, data=data)
-    # if r.status_code != 200:
-    #     raise RuntimeError(f"Token refresh failed: {r.text}")
-    #
-    # payload = r.json()
-    # _token, _exp = payload["access_token"], time.time() + payload["expires_in"]
-    # return _token
+    global _token, _exp
+    if _token and _exp - 60 > time.monotonic():     # Refresh one minute ahead
+        return _token
+
+    async with _token_lock:
+        if _token and _exp - 60 > time.monotonic():     # Refreshed while waiting
+            return _token
+
+        basic = httpx.BasicAuth(CID, CSC)
+        data  = {"grant_type": "client_credentials"}
+        r = await _client.post(SPOTIFY_TOKEN_URL, auth=basic, data=data)
+        if r.status_code != 200:
+            raise HTTPException(status_code=502, detail=f"Token refresh failed: {r.text}")
+
+        payload = r.json()
+        _token, _exp = payload["access_token"], time.monotonic() + payload["expires_in"]
+        return _token
+
+# ─── Tool: Concurrent GET against Spotify Web API ──────────────────
+_sem = asyncio.Semaphore(MAX_PAR)
+async def _sp_get(path: str, **params) -> dict:
+    """
+    GET a Spotify endpoint through the shared httpx pool (async, no Spotipy).
+    - At most MAX_PAR requests in flight; `None` params are dropped.
+    - On 429, waits `Retry-After` (exponential backoff) and retries.
+    - Other errors are re-raised as HTTPException with Spotify's status.
+    """
+    params = {k: v for k, v in params.items() if v is not None}
+    hdrs = {"Authorization": f"Bearer {await bearer()}"}
+    for attempt in range(MAX_RETRY + 1):
+        async with _sem:
+            r = await _client.get(path, params=params, headers=hdrs)
+        if r.status_code != 429 or attempt == MAX_RETRY:
+            break
+        await asyncio.sleep(max(float(r.headers.get("Retry-After", 1)), 2 ** attempt))
+
+    if r.is_error:
+        try:
+            detail = r.json()["error"]["message"]
+        except Exception:
+            detail = r.text
+        raise HTTPException(status_code=r.status_code, detail=detail)
+    return r.json()
+
+_genre_cache: LRUCache = LRUCache(maxsize=10_000)   # artist id → genres (near-static)
+async def inferred_artist_genres_batch(ids: tuple[str, ...]) -> dict[str, list[str]]:
+    """
+    Fetch genres for the given artists and return {artist_id: capitalized genres}.
+    - Cached per artist id; only misses hit `/v1/artists?ids=` (50 ids per call).
+    """
+    missing = [aid for aid in dict.fromkeys(ids) if aid not in _genre_cache]
+    pages = await asyncio.gather(*[
+        _sp_get("/v1/artists", ids=",".join(id_batch)) for id_batch in batched(missing, 50)
+    ])
+    for page in pages:
+        for artist in page["artists"]:   # full Artist objects; null for unknown ids
+            if artist:
+                _genre_cache[artist["id"]] = [genre.capitalize() for genre in artist.get("genres", [])]
+    return {aid: _genre_cache.get(aid, []) for aid in ids}
+
+# ─── Tool: Stream CSV row by row ───────────────────────────────────
+def _csv_rows(fieldnames: list[str], rows: Iterable[tuple]) -> Iterator[str]:
+    """
+    Yield CSV text one row at a time (constant memory, immediate first byte).
+    - Starts with a UTF-8 BOM for Excel compatibility.
+    - Rows are tuples in `fieldnames` order (no per-row dict).
+    """
+    buf = StringIO()
+    writer = csv.writer(buf)
+    yield '\ufeff'
+    writer.writerow(fieldnames)
+    yield buf.getvalue()
+    for row in rows:
+        buf.seek(0)
+        buf.truncate()
+        writer.writerow(row)
+        yield buf.getvalue()
+
+def _csv_response(content: Iterator[str], filename: str) -> StreamingResponse:
+    return StreamingResponse(
+        content,
+        media_type="text/csv; charset=utf-8",
+        headers={
+            "Content-Disposition": f"attachment; filename={filename}",
+            "Content-Type": "text/csv; charset=utf-8"
+        }
+    )
 
 # ─── 1) Transparent Proxy: /v1/... ─────────────────────────────────────
+# Hop-by-hop (and re-framed) headers not forwarded; bytes to match httpx `headers.raw`
+_HOP_BY_HOP = frozenset({
+    b"content-encoding", b"transfer-encoding", b"content-length", b"connection",
+    b"keep-alive", b"proxy-authenticate", b"proxy-authorization", b"te",
+    b"trailers", b"upgrade",
+})
+
 @app.api_route("/v1/{full_path:path}", methods=["GET","POST","PUT","DELETE","PATCH"])
 async def proxy(req: Request, full_path: str) -> Response:
     """
     Equivalent to the official Spotify API.
     - Retains the original QueryString, Body, and Headers.
     - Only appends `Authorization: Bearer <token>`.
+    - Request and response bodies are streamed through, never buffered.
     """
-    qs   = f"?{req.query_params}" if req.query_params else ""
-    url  = f"/v1/{full_path}{qs}"
+    url  = f"/v1/{full_path}"
     hdrs = {"Authorization": f"Bearer {await bearer()}"}
 
-    body = await req.body()
-    method = req.method.lower()
-    httpx_call = getattr(_client, method)
-    if req.method in {"GET", "DELETE"} or not body:
-        r = await _client.request(req.method, url, headers=hdrs)
-    else:
-        r = await _client.request(req.method, url, headers=hdrs, content=body)
-
-    # Filter hop-by-hop headers
-    skip = {"content-encoding", "transfer-encoding", "content-length", "connection"}
-    out_headers = {k: v for k, v in r.headers.items() if k.lower() not in skip}
-
-    return Response(content=r.content,
-                    status_code=r.status_code,
-                    headers=out_headers,
-                    media_type=r.headers.get("content-type"))
+    content = None
+    if req.method not in {"GET", "DELETE"}:
+        if req.headers.get("content-length", "0") != "0":
+            hdrs["Content-Length"] = req.headers["content-length"]
+            content = req.stream()
+        elif "transfer-encoding" in req.headers:      # chunked upload
+            content = req.stream()
+
+    r = await _client.send(
+        _client.build_request(req.method, url, params=req.query_params.multi_items(),
+                              headers=hdrs, content=content),
+        stream=True,
+    )
+
+    # aiter_bytes() yields decoded content, matching the dropped content-encoding
+    resp = StreamingResponse(r.aiter_bytes(),
+                             status_code=r.status_code,
+                             background=BackgroundTask(r.aclose))
+
+    # Filter hop-by-hop headers; forward every remaining pair (repeated headers included).
+    # Upstream content-type is among them, so no media_type above. ASGI wants lowercase names.
+    resp.raw_headers.extend((k, v) for k, v in ((k.lower(), v) for k, v in r.headers.raw)
+                            if k not in _HOP_BY_HOP)
+    return resp
 
 # ─── 2) Deep Expansion: /mp3tag/album/{id} ────────────────────────
 @app.get("/mp3tag/album/{album_id}")
-def expand_album(
+async def expand_album(
     album_id: str,
-    market: str | None = Query(None, pattern="^[A-Za-z]{2}$")   # e.g. ?market=US
-) -> JSONResponse:
+    market: str | None = Query(None, pattern="^[A-Za-z]{2}$"),  # e.g. ?market=US
+    full: bool = Query(False, description="Fetch full Track objects (ISRC, popularity, ...)"),
+) -> ORJSONResponse:
     """
-    - Paginate album tracks to complete them.
-    - Use batch API to fill in complete information for each track.
+    - Paginate album tracks to complete them (pages fetched concurrently).
+    - With `full`, use batch API to fill in complete information for each track;
+      otherwise the simplified tracks already carry the basic MP3tag fields.
     """
-    try:
-        album = sp.album(album_id, market=market)               # Pass-through
-    except spotipy.SpotifyException as e:
-        raise HTTPException(status_code=e.http_status, detail=e.msg)
+    album = await _sp_get(f"/v1/albums/{album_id}", market=market)   # Pass-through
 
     tracks = album["tracks"]
     items: List[dict] = tracks["items"]
@@ -139,19 +223,23 @@ def expand_album(
     limit = tracks["limit"]          # Currently fixed at 50 by Spotify
 
     # --- Complete pagination ---
-    for off in range(limit, total, limit):
-        items.extend(
-            sp.album_tracks(album_id, limit=limit, offset=off, market=market)["items"]
-        )  # type: ignore[attr-defined]
-
-    # --- Batch retrieval for complete track details ---
-    detailed = []
-    for id_batch in batched([t["id"] for t in items], 50):   # Batch API limit is 50
-        # print(id_batch)
-        detailed.extend(sp.tracks(id_batch, market=market)["tracks"])  # type: ignore[attr-defined]
-
-    # Merge detailed track info into original items
-    merge_missing_props_by_id(items, detailed)
+    pages = await asyncio.gather(*[
+        _sp_get(f"/v1/albums/{album_id}/tracks", offset=off, limit=limit, market=market)
+        for off in range(limit, total, limit)
+    ])
+    for page in pages:
+        items.extend(page["items"])
+
+    # --- Batch retrieval for complete track details (external_ids, popularity, album) ---
+    if full:
+        batches = await asyncio.gather(*[
+            _sp_get("/v1/tracks", ids=",".join(id_batch), market=market)
+            for id_batch in batched([t["id"] for t in items], 50)   # Batch API limit is 50
+        ])
+        detailed = [t for b in batches for t in b["tracks"]]
+
+        # Merge detailed track info into original items
+        merge_missing_props_by_id(items, detailed)
 
     # --- Overwrite & Clean-up ---
     tracks["items"] = items  # or use detailed if preferred
@@ -178,17 +266,12 @@ def expand_album(
 
     # After getting the album data, fetch genres from album artists
     # Fetch and merge all artist genres efficiently
-    artist_ids = [artist["id"] for artist in album["artists"]]
-    genres = []
-    seen = set()
-    for artist_id in artist_ids:
-        for genre in inferred_artist_genres(artist_id, sp):
-            if genre not in seen:
-                genres.append({"text": genre})
-                seen.add(genre)
-    album["mp3tag"]["genres"] = genres
-
-    return JSONResponse(content=album)
+    artist_ids = tuple(artist["id"] for artist in album["artists"])
+    artist_genres = await inferred_artist_genres_batch(artist_ids)
+    genres = dict.fromkeys(g for aid in artist_ids for g in artist_genres[aid])   # ordered dedup
+    album["mp3tag"]["genres"] = [{"text": genre} for genre in genres]
+
+    return ORJSONResponse(album)
 
 spmusic_router = APIRouter(prefix="/spmusic", tags=["spmusic"])
 
@@ -211,77 +294,51 @@ async def get_artist_albums(
     
     album_type_str = ",".join(album_types)
 
-    try:
-        # Search for the artist
-        results = sp.search(artist_name, type='artist', limit=1)
-        if not results['artists']['items']:
-            raise HTTPException(status_code=404, detail=f"Artist '{artist_name}' not found")
-        
-        artist = results['artists']['items'][0]
-        
-        # Get all albums for the artist
-        albums = []
-        offset = 0
-        limit = 50  # Spotify API limit
-        
-        # as there is bug in different type search
-        # we need to iterate over each album type
-        albums = []
-        for album_type in album_types:
-            offset = 0
-            while True:
-                results = sp.artist_albums(
-                    artist['id'],
-                    include_groups=album_type,
-                    country=None,  # Use None to get all markets
-                    limit=limit,
-                    offset=offset,
-                )
-                if not results['items']:
-                    break
-                albums.extend(results['items'])
-                if len(results['items']) < limit:
-                    break
-                offset += limit
-
-        if down:
-            # Prepare CSV with UTF-8 BOM for Excel compatibility
-            output = StringIO()
-            output.write('\ufeff')  # Add UTF-8 BOM
-            writer = csv.DictWriter(
-                output,
-                fieldnames=["release_date", "album_type", "albumartist", "name", "id", "total_tracks", "external_url"],
-                extrasaction='ignore'
-            )
-            writer.writeheader()
-            for album in albums:
-                writer.writerow({
-                    "release_date": album.get("release_date"),
-                    "album_type": album.get("album_type"),
-                    "albumartist": artist_name,
-                    "name": album.get("name"),
-                    "id": album.get("id"),
-                    "total_tracks": album.get("total_tracks"),
-                    "external_url": album.get("external_urls", {}).get("spotify"),
-                })
-            output.seek(0)
-            safe_artist_name = artist_name.replace(' ', '_')
-            return StreamingResponse(
-                output,
-                media_type="text/csv; charset=utf-8",
-                headers={
-                    "Content-Disposition": f"attachment; filename={safe_artist_name}_spotify_albums.csv",
-                    "Content-Type": "text/csv; charset=utf-8"
-                }
-            )
-        else:
-            return JSONResponse(content={
-                "artist": artist,
-                "albums": albums
-            })
-        
-    except spotipy.SpotifyException as e:
-        raise HTTPException(status_code=e.http_status, detail=e.msg)
+    # Search for the artist
+    results = await _sp_get("/v1/search", q=artist_name, type="artist", limit=1)
+    if not results['artists']['items']:
+        raise HTTPException(status_code=404, detail=f"Artist '{artist_name}' not found")
+
+    artist = results['artists']['items'][0]
+
+    # Get all albums for the artist: every group in one pagination (pages fetched concurrently)
+    limit = 50  # Spotify API limit
+    path = f"/v1/artists/{artist['id']}/albums"
+    first = await _sp_get(path, include_groups=album_type_str, limit=limit)   # no market → all markets
+    pages = [first, *await asyncio.gather(*[
+        _sp_get(path, include_groups=album_type_str, limit=limit, offset=off)
+        for off in range(limit, first["total"], limit)
+    ])]
+
+    # The combined query's `total` was seen to be unreliable ("bug in different type
+    # search"), so keep paging sequentially until a short page instead of trusting it
+    fetched = sum(len(page["items"]) for page in pages)
+    while len(pages[-1]["items"]) == limit:
+        pages.append(await _sp_get(path, include_groups=album_type_str, limit=limit, offset=fetched))
+        fetched += len(pages[-1]["items"])
+
+    # An album may be listed under more than one group; keep its first occurrence
+    unique: dict[str, dict] = {}
+    for page in pages:
+        for album in page["items"]:
+            unique.setdefault(album["id"], album)
+    albums = list(unique.values())
+
+    if down:
+        def row(a):
+            return (a.get("release_date"), a.get("album_type"), artist_name, a.get("name"),
+                    a.get("id"), a.get("total_tracks"), (a.get("external_urls") or {}).get("spotify"))
+        safe_artist_name = artist_name.replace(' ', '_')
+        return _csv_response(
+            _csv_rows(["release_date", "album_type", "albumartist", "name", "id", "total_tracks", "external_url"],
+                      map(row, albums)),
+            f"{safe_artist_name}_spotify_albums.csv",
+        )
+    else:
+        return ORJSONResponse({
+            "artist": artist,
+            "albums": albums
+        })
 
 # ─── 3) YouTube Music Album Finder ────────────────────────────────
 # only artist full album mode, to avoid iterated searches
@@ -305,6 +362,10 @@ def _artists(hit):
         return ", ".join(a["name"] for a in hit["artists"])
     return ""
 
+_album_url_cache: TTLCache = TTLCache(maxsize=50_000, ttl=24 * 3600)   # browseId → urls
+_yt_search_cache: TTLCache = TTLCache(maxsize=10_000, ttl=3600)        # artist name → hits
+
+@cached(_album_url_cache, lock=threading.Lock())   # called from worker threads
 def browse_to_urls(browse_id: str) -> dict:
     # Case 1 – already a playlist-style ID (VL…, PL…): just use it
     if browse_id.startswith(('VL', 'PL')):
@@ -321,6 +382,12 @@ def browse_to_urls(browse_id: str) -> dict:
         "browse_url":   f"https://music.youtube.com/browse/{browse_id}"
     }
 
+_yt_sem = asyncio.Semaphore(MAX_PAR)
+async def browse_to_urls_async(browse_id: str) -> dict:
+    # ytmusicapi is synchronous (requests); run it on a worker thread, MAX_PAR at a time
+    async with _yt_sem:
+        return await asyncio.to_thread(browse_to_urls, browse_id)
+
 @ytmusic_router.get("/albums/by-artist/{artist_name}")
 async def ytmusic_albums_by_artist(
     artist_name: str,
@@ -330,7 +397,10 @@ async def ytmusic_albums_by_artist(
     Search YouTube Music albums by artist name.
     Returns JSON or CSV depending on `csv` query param.
     """
-    hits = yt.search(artist_name, filter="albums", limit=250)
+    hits = _yt_search_cache.get(artist_name)
+    if hits is None:
+        hits = await asyncio.to_thread(yt.search, artist_name, filter="albums", limit=250)
+        _yt_search_cache[artist_name] = hits
     albums = []
     for h in hits:
         album = {
@@ -344,34 +414,18 @@ async def ytmusic_albums_by_artist(
         albums.append(album)
 
     if down:
-        output = StringIO()
-        output.write('\ufeff')
-        writer = csv.DictWriter(
-            output,
-            fieldnames=["title", "artist", "year", "browseId", "audioPlaylistId", "trackCount", "playlist_url", "browse_url"],
-            extrasaction='ignore'
-        )
-        writer.writeheader()
-        for album_batch in batched(albums, 50):
-            batch_with_urls = []
-            for album in album_batch:
-                urls = browse_to_urls(album["browseId"]) if album.get("browseId") else {"playlist_url": "", "browse_url": ""}
-                batch_with_urls.append({
-                    **album,
-                    "playlist_url": urls.get("playlist_url", ""),
-                    "browse_url": urls.get("browse_url", ""),
-                })
-            for album in batch_with_urls:
-               writer.writerow(album)
-        output.seek(0)
+        browse_ids = list(dict.fromkeys(a["browseId"] for a in albums if a.get("browseId")))
+        url_map = dict(zip(browse_ids, await asyncio.gather(*map(browse_to_urls_async, browse_ids))))
+        no_urls = {"playlist_url": "", "browse_url": ""}
+        def row(a):
+            urls = url_map.get(a["browseId"], no_urls)
+            return (a["title"], a["artist"], a["year"], a["browseId"], a["audioPlaylistId"],
+                    a["trackCount"], urls["playlist_url"], urls["browse_url"])
         safe_artist_name = artist_name.replace(' ', '_')
-        return StreamingResponse(
-            output,
-            media_type="text/csv; charset=utf-8",
-            headers={
-                "Content-Disposition": f"attachment; filename={safe_artist_name}_ytmusic_albums.csv",
-                "Content-Type": "text/csv; charset=utf-8"
-            }
+        return _csv_response(
+            _csv_rows(["title", "artist", "year", "browseId", "audioPlaylistId", "trackCount", "playlist_url", "browse_url"],
+                      map(row, albums)),
+            f"{safe_artist_name}_ytmusic_albums.csv",
         )
     return {"artist": artist_name, "albums": albums}
 
@@ -1,5 +1,13 @@
-from collections.abc import MutableMapping, Sequence
-from copy import deepcopy
+"""
+Fill-only merge of Spotify JSON objects.
+
+Ownership: values missing from Ad are moved over from Bd by reference, not
+copied. Bd must be treated as consumed after merging (do not mutate it).
+
+Containers are classified with `type(x) is dict/list`: json decoding never
+produces subclasses, and the exact check is much cheaper than ABC isinstance.
+"""
+
 
 def merge_missing_props_by_id(
     Ad: list[dict],
@@ -10,57 +18,74 @@ def merge_missing_props_by_id(
     """
     In-place update of Ad:
     - Aligns the top-level list by index (since album track positions are generally fixed)
-    - For nested list[dict] elements, converts them into dicts keyed by id and then recursively merges
+    - For nested list[dict] elements, converts them into dicts keyed by id and then merges
     - Supplements only when Ad is missing information; never overwrites existing values
     """
     if len(Ad) != len(Bd):
         raise ValueError("Top-level list lengths are inconsistent and cannot be merged by index.")
 
     for a_dict, b_dict in zip(Ad, Bd):
-        if not isinstance(a_dict, MutableMapping) or not isinstance(b_dict, MutableMapping):
+        if type(a_dict) is not dict or type(b_dict) is not dict:
             raise TypeError("Top-level elements of both Ad and Bd must be dicts.")
-        _merge_dict(a_dict, b_dict, id_key=id_key)
 
+    # Iterative worklist of (da, db) pairs instead of recursion:
+    # fill missing keys in da from db (only adds missing values)
+    stack = list(zip(Ad, Bd))
+    while stack:
+        da, db = stack.pop()
+        for k, vb in db.items():
+            if k not in da:
+                # da is completely missing this key; take over db's value
+                da[k] = vb
+                continue
 
-def _merge_dict(da: MutableMapping, db: MutableMapping, *, id_key: str) -> None:
-    """Recursively fill missing keys in da from db (only adds missing values)"""
-    for k, vb in db.items():
-        if k not in da:
-            # da is completely missing this key; add a deep copy
-            da[k] = deepcopy(vb)
-            continue
+            va = da[k]
+            t = type(va)
 
-        va = da[k]
+            # Case 1: Both are dicts; merge later.
+            if t is dict and type(vb) is dict:
+                stack.append((va, vb))
 
-        # Case 1: Both are dicts; recurse.
-        if isinstance(va, MutableMapping) and isinstance(vb, MutableMapping):
-            _merge_dict(va, vb, id_key=id_key)
+            # Case 2: Both are lists of dicts with the unique id key (classified by vb[0]);
+            #         merge based on that key.
+            elif (
+                t is list and type(vb) is list and vb
+                and type(vb[0]) is dict and id_key in vb[0]
+            ):
+                _merge_list_by_id(va, vb, stack, id_key=id_key)
 
-        # Case 2: Both are lists of dicts with the unique id key; merge based on that key.
-        elif (
-            isinstance(va, list) and isinstance(vb, list)
-            and all(isinstance(x, MutableMapping) and id_key in x for x in vb)
-        ):
-            _merge_list_by_id(va, vb, id_key=id_key)
-
-        # Case 3: Other types; only override if va is "missing".
-        else:
-            if _is_missing(va):
-                da[k] = deepcopy(vb)
+            # Case 3: Other types; only override if va is "missing".
+            elif _is_missing(va):
+                da[k] = vb
 
 
-def _merge_list_by_id(la: list[dict], lb: list[dict], *, id_key: str) -> None:
-    """Align la ← lb using id_key; order follows lb"""
-    index_a = {item[id_key]: item for item in la if id_key in item}
-
-    for item_b in lb:
+def _merge_list_by_id(la: list[dict], lb: list[dict], stack: list, *, id_key: str) -> None:
+    """
+    Align la ← lb using id_key; order follows lb. Matched pairs are pushed onto stack.
+    Items are matched by position while la and lb line up; the id index over la
+    is only built on the first positional mismatch.
+    Assumes ids are unique within la (true for Spotify lists): with duplicates, a
+    positional match may pick a different item than the index (last occurrence).
+    Caller guarantees lb is non-empty.
+    """
+    n = len(la)
+    index_a = None
+    for i, item_b in enumerate(lb):
         uid = item_b[id_key]
+        if index_a is None:
+            item_a = la[i] if i < n else None
+            if type(item_a) is dict and id_key in item_a and item_a[id_key] == uid:
+                # Same position, same id → supplement later
+                stack.append((item_a, item_b))
+                continue
+            index_a = {item[id_key]: item for item in la[:n] if id_key in item}
+
         if uid in index_a:
-            # Already exists → recursively supplement
-            _merge_dict(index_a[uid], item_b, id_key=id_key)
+            # Already exists → supplement later
+            stack.append((index_a[uid], item_b))
         else:
-            # Ad is completely missing this element → append a deep copy
-            la.append(deepcopy(item_b))
+            # Ad is completely missing this element → take over item_b
+            la.append(item_b)
 
 
 def _is_missing(value) -> bool: